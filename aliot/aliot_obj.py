@@ -2,12 +2,16 @@ from __future__ import annotations
 
 import json
 import warnings
+from collections import defaultdict
 from functools import wraps
-from threading import Thread
+from queue import SimpleQueue
+from threading import Event, Thread
 from typing import TYPE_CHECKING
 from time import ctime, sleep
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from aliot.exceptions.should_not_call_error import ShouldNotCallError
 
@@ -17,7 +21,7 @@ if TYPE_CHECKING:
 
 from typing import Optional, Callable
 
-from websocket import WebSocketApp
+from websocket import WebSocketApp, WebSocketConnectionClosedException, WebSocketException
 import websocket
 
 from aliot.core._cli.utils import (
@@ -33,20 +37,77 @@ from aliot.constants import ALIVE_IOT_EVENT
 from aliot.decoder import DefaultDecoder
 from aliot.encoder import DefaultEncoder
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 _no_value = object()
 
+# Seconds stop() waits for the queued events to be sent before closing the connection
+_STOP_FLUSH_TIMEOUT = 5
+
+# parses the HTTP responses straight from their bytes
+_loads = orjson.loads if orjson is not None else json.loads
+
 
 class AliotObj:
-    def __init__(self, name: str):
+    # "__dict__" keeps user code able to set its own attributes on the object
+    __slots__ = (
+        "__name",
+        "__strict_utf8",
+        "__ws",
+        "__out_queue",
+        "__sender",
+        "__encoder",
+        "__decoder",
+        "__config",
+        "__protocols",
+        "__listener_funcs",
+        "__listener_fields",
+        "__field_to_listeners",
+        "__broadcast_listener",
+        "__connected_to_alivecode",
+        "__connected_event",
+        "__connected",
+        "__stopped",
+        "__on_start",
+        "__on_end",
+        "__repeats",
+        "__last_freeze",
+        "__listeners_set",
+        "__api_url",
+        "__ws_url",
+        "__object_id",
+        "__auth_token",
+        "__http",
+        "__log",
+        "__event_handlers",
+        "__pong_frame",
+        "__connect_frame",
+        "retry_connection_amount",
+        "__dict__",
+        "__weakref__",
+    )
+
+    def __init__(self, name: str, *, strict_utf8: bool = False):
         self.__name = name
+        self.__strict_utf8 = strict_utf8
         self.__ws: Optional[WebSocketApp] = None
+        self.__out_queue: Optional[SimpleQueue] = None
+        self.__sender: Optional[Thread] = None
         self.__encoder = DefaultEncoder()
         self.__decoder = DefaultDecoder()
         self.__config = get_config()
         self.__protocols = {}
-        self.__listeners = []
+        # listeners are stored as parallel lists: the function and the fields of the i-th listener
+        self.__listener_funcs: list[Callable[[dict], None]] = []
+        self.__listener_fields: list[list[str]] = []
+        # maps each listened field to the indexes of its listeners in the lists above
+        self.__field_to_listeners: dict[str, list[int]] = {}
         self.__broadcast_listener: Optional[Callable[[dict], None]] = None
         self.__connected_to_alivecode = False
+        self.__connected_event = Event()
         self.__connected = False
         self.__stopped = False
         self.__on_start: Optional[tuple[Callable, tuple, dict]] = None
@@ -56,7 +117,21 @@ class AliotObj:
         self.__listeners_set = 0
         self.__api_url: str = self.__get_config_value("api_url")
         self.__ws_url: str = self.__get_config_value("ws_url")
+        self.__object_id: Optional[str] = self.__get_config_value("obj_id")
+        self.__auth_token: Optional[str] = self.__get_config_value("auth_token")
+        self.__http = self.__make_http_session()
         self.__log = False
+        # handlers of the received events, looked up by __on_message for every message
+        self.__event_handlers: dict[str, Callable[[object], None]] = {
+            ALIVE_IOT_EVENT.CONNECT_SUCCESS.value: self.__connect_success,
+            ALIVE_IOT_EVENT.RECEIVE_ACTION.value: self.__execute_protocol,
+            ALIVE_IOT_EVENT.RECEIVE_LISTEN.value: self.__handle_listen,
+            ALIVE_IOT_EVENT.RECEIVE_BROADCAST.value: self.__handle_broadcast,
+            ALIVE_IOT_EVENT.SUBSCRIBE_LISTENER_SUCCESS.value: self.__subscribe_listener_success,
+            ALIVE_IOT_EVENT.ERROR.value: self.__handle_error_event,
+            ALIVE_IOT_EVENT.PING.value: self.__handle_ping,
+        }
+        self.__encode_static_frames()
 
     # ################################# Properties ################################# #
 
@@ -71,6 +146,7 @@ class AliotObj:
     @encoder.setter
     def encoder(self, encoder: Encoder):
         self.__encoder = encoder
+        self.__encode_static_frames()
 
     @property
     def decoder(self) -> Decoder:
@@ -82,11 +158,11 @@ class AliotObj:
 
     @property
     def object_id(self):
-        return self.__get_config_value("obj_id")
+        return self.__object_id
 
     @property
     def auth_token(self):
-        return self.__get_config_value("auth_token")
+        return self.__auth_token
 
     @property
     def protocols(self):
@@ -96,7 +172,10 @@ class AliotObj:
     @property
     def listeners(self):
         """Returns a copy of the listeners list"""
-        return self.__listeners.copy()
+        return [
+            {"func": func, "fields": list(fields)}
+            for func, fields in zip(self.__listener_funcs, self.__listener_fields)
+        ]
 
     @property
     def broadcast_listener(self):
@@ -109,6 +188,10 @@ class AliotObj:
     @connected_to_alivecode.setter
     def connected_to_alivecode(self, value: bool):
         self.__connected_to_alivecode = value
+        if value:
+            self.__connected_event.set()
+        else:
+            self.__connected_event.clear()
         if not value and self.__connected:
             self.__ws.close()
 
@@ -116,7 +199,9 @@ class AliotObj:
 
     def run(self, *, enable_trace: bool = False, log: bool = False, retry = True, retry_time = None):
         self.__log = log
-        self.__setup_ws(enable_trace)
+        # the trace handler is global to websocket-client, so it is set once per run, not per connection
+        websocket.enableTrace(enable_trace)
+        self.__setup_ws()
         
         first_retry = True
         self.retry_connection_amount = 0
@@ -132,7 +217,7 @@ class AliotObj:
                 print_info("Please note that you can disable connect retry with retry=False when calling run(). You can also change the retry time to a fix amount by passing retry_time=<SECONDS> .")
             
             sleep(waitTime)
-            self.__setup_ws(enable_trace)
+            self.__setup_ws()
             
             # Constraint retry amount for exponential wait time
             self.retry_connection_amount += 1
@@ -142,6 +227,10 @@ class AliotObj:
     def stop(self):
         if self.__connected and self.__ws:
             self.__stopped = True
+            # lets the sender flush the events queued before the stop, without waiting forever
+            # on a peer that stopped reading
+            self.__out_queue.put(None)
+            self.__sender.join(timeout=_STOP_FLUSH_TIMEOUT)
             self.__ws.close()
 
     def update_component(self, id: str, value):
@@ -161,13 +250,13 @@ class AliotObj:
     def get_doc(self, field: Optional[str] = None):
 
         if field:
-            res = requests.post(
+            res = self.__http.post(
                 f"{self.__api_url}/iot/aliot/{ALIVE_IOT_EVENT.GET_FIELD.value}",
-                {"id": self.object_id, "field": field},
+                {"id": self.__object_id, "field": field},
             )
             status = res.status_code
             if status == 201:
-                return json.loads(res.text) if res.text else None
+                return _loads(res.content) if res.content else None
             elif status == 403:
                 print_err(
                     f"While getting the field {field}, "
@@ -183,13 +272,13 @@ class AliotObj:
                     f"While getting the field {field}, please try again. {res.json()!r}"
                 )
         else:
-            res = requests.post(
+            res = self.__http.post(
                 f"{self.__api_url}/iot/aliot/{ALIVE_IOT_EVENT.GET_DOC.value}",
-                {"id": self.object_id},
+                {"id": self.__object_id},
             )
             status = res.status_code
             if status == 201:
-                return json.loads(res.text) if res.text else None
+                return _loads(res.content) if res.content else None
             elif status == 403:
                 print_err(
                     f"While getting the document, request was Forbidden due "
@@ -341,7 +430,7 @@ class AliotObj:
             def wrapper(fields: dict):
                 result = func(fields)
 
-            self.__listeners.append({"func": wrapper, "fields": fields})
+            self.__register_listener(wrapper, fields)
             return wrapper
 
         if callback is not None:
@@ -355,7 +444,7 @@ class AliotObj:
             def wrapper(fields: dict):
                 result = func(fields)
 
-            self.__listeners.append({"func": wrapper, "fields": fields})
+            self.__register_listener(wrapper, fields)
             return wrapper
 
         if callback is not None:
@@ -391,8 +480,7 @@ class AliotObj:
         def inner(main_loop_func):
             @wraps(main_loop_func)
             def wrapper():
-                while not self.connected_to_alivecode:
-                    pass
+                self.__connected_event.wait()
                 if repetitions is not None:
                     for _ in range(repetitions):
                         if not self.connected_to_alivecode:
@@ -402,7 +490,7 @@ class AliotObj:
                     while self.connected_to_alivecode:
                         main_loop_func()
 
-            self.__on_start = wrapper
+            self.__on_start = (wrapper, (), {})
             return wrapper
 
         if callback is not None:
@@ -421,49 +509,119 @@ class AliotObj:
             self.__name, key, fallback=None
         ) or self.__config.defaults().get(key)
 
+    def __make_http_session(self) -> requests.Session:
+        """Creates the session reused by get_doc so every request doesn't pay a new TCP+TLS handshake"""
+        session = requests.Session()
+        session.headers["Connection"] = "keep-alive"
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=8,
+            max_retries=Retry(total=3, backoff_factor=0.2),
+        )
+        if self.__api_url:
+            session.mount(self.__api_url, adapter)
+        return session
+
+    def __encode_static_frames(self):
+        """Encodes once the events whose content never changes for this object"""
+        self.__pong_frame = self.__encoder.encode(
+            {"event": ALIVE_IOT_EVENT.PONG.value, "data": None}
+        )
+        self.__connect_frame = self.__encoder.encode(
+            {
+                "event": ALIVE_IOT_EVENT.CONNECT_OBJECT.value,
+                "data": {"id": self.__object_id, "token": self.__auth_token},
+            }
+        )
+
+    def __send_raw(self, data_encoded: str | bytes):
+        if self.__connected:
+            self.__out_queue.put(data_encoded)
+            self.__repeats += 1
+
     def __send_event(self, event: ALIVE_IOT_EVENT, data: Optional[dict]):
         if self.__connected:
             data_sent = {"event": event.value, "data": data}
-            data_encoded = self.encoder.encode(data_sent)
-            self.__log_info(f"[Encoding] {data_sent!r}")
-            self.__log_info(f"[Sending] {data_encoded!r}")
-            self.__ws.send(data_encoded)
-            self.__repeats += 1
+            # encoded on the caller's thread: the data can be mutated by the caller once we return
+            data_encoded = self.__encoder.encode(data_sent)
+            if self.__log:
+                self.__log_info(f"[Encoding] {data_sent!r}")
+            self.__send_raw(data_encoded)
+
+    def __sender_loop(self, ws: WebSocketApp, out_queue: SimpleQueue):
+        """Sends the encoded events queued by __send_raw until the None sentinel is received"""
+        # the socket is connected once the sender is started: sending on it directly skips
+        # WebSocketApp.send's lookups for every event. The encoded events stay text frames
+        send = ws.sock.send if ws.sock is not None else ws.send
+        data_encoded = out_queue.get()
+        while data_encoded is not None:
+            if self.__log:
+                self.__log_info(f"[Sending] {data_encoded!r}")
+            try:
+                # like WebSocketApp.send, a write of 0 bytes means the socket is closed
+                if send(data_encoded) == 0:
+                    raise WebSocketConnectionClosedException("Connection is already closed.")
+            except (WebSocketException, OSError) as e:
+                print_err(f"While sending {data_encoded!r}: {e!r}")
+                # closing goes through __on_close, which stops queueing and lets run() reconnect
+                ws.close()
+                return
+            data_encoded = out_queue.get()
+
+    def __register_listener(self, func: Callable[[dict], None], fields: list[str]):
+        index = len(self.__listener_funcs)
+        self.__listener_funcs.append(func)
+        self.__listener_fields.append(list(fields))
+        # a field listed twice is indexed once so the listener is not called twice
+        for field in frozenset(fields):
+            self.__field_to_listeners.setdefault(field, []).append(index)
 
     def __execute_listen(self, fields: dict):
-        for listener in self.listeners:
-            fields_to_return = {
-                field: value
-                for field, value in fields.items()
-                if field in listener["fields"]
-            }
-            if len(fields_to_return) > 0:
-                listener["func"](fields_to_return)
+        fields_by_listener: defaultdict[int, dict] = defaultdict(dict)
+        for field, value in fields.items():
+            for index in self.__field_to_listeners.get(field, ()):
+                fields_by_listener[index][field] = value
+
+        # listeners are called in the order they were registered
+        listener_funcs = self.__listener_funcs
+        for index in sorted(fields_by_listener):
+            listener_funcs[index](fields_by_listener[index])
 
     def __execute_broadcast(self, data: dict):
-        if self.broadcast_listener:
-            self.broadcast_listener(data)
+        if self.__broadcast_listener:
+            self.__broadcast_listener(data)
 
     def __execute_protocol(self, msg: dict | list):
-        if isinstance(msg, list):
-            for m in msg:
-                self.__execute_protocol(m)
-        print(msg)
-        must_have_keys = "id", "value"
-        if not all(key in msg for key in must_have_keys):
-            print("the message received does not have a valid structure")
-            return
-
-        msg_id = msg["id"]
-        protocol = self.protocols.get(msg_id)
-
-        if protocol is None:
-            print_err(f"The protocol with the id {msg_id!r} is not implemented")
-        else:
-            protocol(msg["value"])
+        # the server can batch several actions in a single message, and batches can be nested.
+        # They are flattened in order with a stack instead of recursing
+        pending = [msg]
+        protocols = self.__protocols
+
+        while pending:
+            msg = pending.pop()
+            if isinstance(msg, list):
+                pending.extend(reversed(msg))
+                continue
+
+            if self.__log:
+                self.__log_info(f"[Protocol] {msg!r}")
+            msg_id = value = _no_value
+            if isinstance(msg, dict):
+                msg_id = msg.get("id", _no_value)
+                value = msg.get("value", _no_value)
+            if msg_id is _no_value or value is _no_value:
+                print_warning("the message received does not have a valid structure")
+                continue
+
+            protocol = protocols.get(msg_id)
+
+            if protocol is None:
+                print_err(f"The protocol with the id {msg_id!r} is not implemented")
+            else:
+                protocol(value)
 
-    def __connect_success(self):
-        if len(self.__listeners) == 0:
+    def __connect_success(self, data):
+        if len(self.__listener_funcs) == 0:
             print_success(f"Object {self.name!r}", success_name="Connected")
             self.connected_to_alivecode = True
 
@@ -475,13 +633,11 @@ class AliotObj:
             ).start()
 
         else:
-            # Register listeners on ALIVEcode
-            fields = sorted(
-                set([field for l in self.listeners for field in l["fields"]])
-            )
+            # Register listeners on ALIVEcode, the field index holds every listened field once
+            fields = sorted(self.__field_to_listeners)
             self.__send_event(ALIVE_IOT_EVENT.SUBSCRIBE_LISTENER, {"fields": fields})
 
-    def __subscribe_listener_success(self):
+    def __subscribe_listener_success(self, data):
         print_success(success_name="Connected")
         self.connected_to_alivecode = True
         self.__on_start and Thread(
@@ -497,39 +653,30 @@ class AliotObj:
             self.connected_to_alivecode = False
             print_fail(failure_name="Connection closed due to an error")
 
-    # ################################# Websocket methods ################################# #
-
-    def __on_message(self, ws, message):
-        msg = self.decoder.decode(message)
-
-        event: str = msg["event"]
-        data = msg["data"]
-
-        if event == ALIVE_IOT_EVENT.CONNECT_SUCCESS.value:
-            self.__connect_success()
+    def __handle_error_event(self, data):
+        if data == "Forbidden. Invalid credentials.":
+            self.__handle_error(data, True)
+        elif "is not registered" in data:
+            self.__handle_error(data, True)
+        else:
+            self.__handle_error(data)
 
-        elif event == ALIVE_IOT_EVENT.RECEIVE_ACTION.value:
-            self.__execute_protocol(data)
+    def __handle_listen(self, data: dict):
+        self.__execute_listen(data["fields"])
 
-        elif event == ALIVE_IOT_EVENT.RECEIVE_LISTEN.value:
-            self.__execute_listen(data["fields"])
+    def __handle_broadcast(self, data: dict):
+        self.__execute_broadcast(data["data"])
 
-        elif event == ALIVE_IOT_EVENT.RECEIVE_BROADCAST.value:
-            self.__execute_broadcast(data["data"])
+    def __handle_ping(self, data):
+        self.__send_raw(self.__pong_frame)
 
-        elif event == ALIVE_IOT_EVENT.SUBSCRIBE_LISTENER_SUCCESS.value:
-            self.__subscribe_listener_success()
+    # ################################# Websocket methods ################################# #
 
-        elif event == ALIVE_IOT_EVENT.ERROR.value:
-            if data == "Forbidden. Invalid credentials.":
-                self.__handle_error(data, True)
-            elif "is not registered" in data:
-                self.__handle_error(data, True)
-            else:
-                self.__handle_error(data)
+    def __on_message(self, ws, message):
+        msg = self.__decoder.decode(message)
 
-        elif event == ALIVE_IOT_EVENT.PING.value:
-            self.__send_event(ALIVE_IOT_EVENT.PONG, None)
+        handler = self.__event_handlers.get(msg["event"])
+        handler and handler(msg["data"])
 
     def __on_error(self, ws: WebSocketApp, error):
         print_err(f"{error!r}")
@@ -546,6 +693,11 @@ class AliotObj:
     def __on_close(self, ws: WebSocketApp, status_code, msg):
         self.__connected = False
         self.__connected_to_alivecode = False
+        self.__connected_event.clear()
+        if self.__out_queue is not None:
+            # wakes up the sender so it can exit
+            self.__out_queue.put(None)
+        self.__http.close()
         self.__on_end and self.__on_end[0](*self.__on_end[1], **self.__on_end[2])
 
         if status_code is not None or msg is not None:
@@ -560,28 +712,31 @@ class AliotObj:
 
 
     def __on_open(self, ws):
+        # Each connection gets its own queue so a late sender never writes on a new socket
+        self.__out_queue = SimpleQueue()
+        self.__sender = Thread(
+            target=self.__sender_loop, args=(ws, self.__out_queue), daemon=True
+        )
+        self.__sender.start()
+
         # Register IoTObject on ALIVEcode
         self.__connected = True
         self.retry_connection_amount = 0
-        token = self.auth_token
+        token = self.__auth_token
         if token is None:
             self.__handle_error(
                 "IoTObjects now require an AuthToken to securely connect to ALIVEiot. Please make sure to register an AuthToken on your IoTObject on ALIVEcode from your IoT Dashboard and add in your config.ini: auth_token = <your_auth_token>",
                 terminate=True,
             )
         else:
-            self.__send_event(
-                ALIVE_IOT_EVENT.CONNECT_OBJECT,
-                {"id": self.object_id, "token": self.auth_token},
-            )
+            self.__send_raw(self.__connect_frame)
         # if self.__main_loop is None:
         #     self.__ws.close()
         #     raise NotImplementedError("You must define a main loop")
         # Thread(target=self.__main_loop, daemon=True).start()
 
-    def __setup_ws(self, enable_trace: bool = False):
+    def __setup_ws(self):
         print_info("...", info_name="Connecting")
-        websocket.enableTrace(enable_trace)
         self.__ws = WebSocketApp(
             self.__ws_url,
             on_open=self.__on_open,
@@ -589,4 +744,8 @@ class AliotObj:
             on_error=self.__on_error,
             on_close=self.__on_close,
         )
-        self.__ws.run_forever()
+        self.__ws.run_forever(
+            skip_utf8_validation=not self.__strict_utf8,
+            ping_interval=20,
+            ping_timeout=10,
+        )
@@ -1,11 +1,19 @@
+from __future__ import annotations
+
 import json
 from abc import ABC, abstractmethod
 from typing import Any
 
+try:
+    import orjson
+except ImportError:
+    # orjson is an optional speedup (pip install aliot-py[fast]), json is used without it
+    orjson = None
+
 
 class Decoder(ABC):
     @abstractmethod
-    def decode(self, value: str) -> Any:
+    def decode(self, value: str | bytes) -> Any:
         """ Decode value from the string sent by the server """
         ...
 
@@ -14,5 +22,11 @@ class DefaultDecoder(Decoder):
     def __init__(self):
         pass
 
-    def decode(self, value: str):
-        return json.loads(value)
+    def decode(self, value: str | bytes):
+        if orjson is None:
+            return json.loads(value)
+        try:
+            return orjson.loads(value)
+        except orjson.JSONDecodeError:
+            # orjson refuses what json accepts, like lone surrogate escapes from JSON.stringify
+            return json.loads(value)
@@ -1,11 +1,19 @@
+from __future__ import annotations
+
 import json
 from abc import ABC, abstractmethod
 
+try:
+    import orjson
+except ImportError:
+    # orjson is an optional speedup (pip install aliot-py[fast]), json is used without it
+    orjson = None
+
 
 class Encoder(ABC):
     @abstractmethod
-    def encode(self, value) -> str:
-        """ Encode value to a string before sending it to server """
+    def encode(self, value) -> str | bytes:
+        """ Encode value to a string (or utf-8 bytes) before sending it to server """
         ...
 
 
@@ -13,5 +21,11 @@ class DefaultEncoder(Encoder):
     def __init__(self):
         pass
 
-    def encode(self, value) -> str:
-        return json.dumps(value, default=str)
+    def encode(self, value) -> str | bytes:
+        if orjson is None:
+            return json.dumps(value, default=str)
+        try:
+            return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            # orjson refuses what json accepts, like integers wider than 64 bits
+            return json.dumps(value, default=str)
@@ -34,6 +34,7 @@ if __name__ == "__main__":
             "requests~=2.27.1",
             "setuptools==62.1.0",
         ],
+        extras_require={"fast": ["orjson~=3.8.3"]},
         setup_requires="setuptools",
         entry_points={"console_scripts": ["aliot = aliot.core._cli.aliot_cli:main"]},
     )
@@ -0,0 +1,183 @@
+import json
+import threading
+
+import pytest
+
+from aliot.aliot_obj import AliotObj
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, payload, opcode=None):
+        self.sent.append(payload)
+        return len(payload)
+
+
+class FakeWebSocketApp:
+    def __init__(self):
+        self.sock = FakeSocket()
+        self.closed = False
+
+    def send(self, payload):
+        self.sock.send(payload)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def ws():
+    return FakeWebSocketApp()
+
+
+@pytest.fixture
+def obj(ws):
+    obj = AliotObj("test")
+    obj._AliotObj__ws = ws
+    return obj
+
+
+def connect(obj: AliotObj, ws: FakeWebSocketApp):
+    obj._AliotObj__on_open(ws)
+
+
+def receive(obj: AliotObj, event: str, data):
+    obj._AliotObj__on_message(None, json.dumps({"event": event, "data": data}))
+
+
+def sent_events(ws: FakeWebSocketApp, event: str):
+    messages = [json.loads(payload) for payload in ws.sock.sent]
+    return [message["data"] for message in messages if message["event"] == event]
+
+
+def test_update_doc_sends_the_fields_at_call_time(obj, ws):
+    connect(obj, ws)
+    fields = {}
+    for i in range(5):
+        fields["v"] = i
+        obj.update_doc(fields)
+    obj.stop()
+
+    assert sent_events(ws, "update_doc") == [{"fields": {"v": i}} for i in range(5)]
+
+
+def test_send_error_closes_the_connection(obj, ws):
+    def broken_send(payload, opcode=None):
+        raise BrokenPipeError()
+
+    ws.sock.send = broken_send
+    connect(obj, ws)
+    obj._AliotObj__sender.join(timeout=1)
+
+    assert not obj._AliotObj__sender.is_alive()
+    assert ws.closed
+
+
+def test_empty_write_closes_the_connection(obj, ws):
+    ws.sock.send = lambda payload, opcode=None: 0
+    connect(obj, ws)
+    obj._AliotObj__sender.join(timeout=1)
+
+    assert not obj._AliotObj__sender.is_alive()
+    assert ws.closed
+
+
+def test_listeners_keep_the_fields_as_given(obj):
+    fields = ["b", "a", "b"]
+    obj.listen(fields, lambda f: None)
+    listeners = obj.listeners
+    listeners[0]["fields"].append("c")
+
+    assert obj.listeners[0]["fields"] == ["b", "a", "b"]
+
+
+@pytest.fixture
+def listened(obj):
+    calls = []
+    obj.listen(["b", "a"], lambda fields: calls.append(("first", fields)))
+    obj.listen_doc(["c", "a", "c"], lambda fields: calls.append(("second", fields)))
+    obj.listen(["z"], lambda fields: calls.append(("third", fields)))
+    return calls
+
+
+def test_listeners_are_subscribed_to_every_field_once(obj, ws, listened):
+    connect(obj, ws)
+    receive(obj, "connect_success", None)
+    obj.stop()
+
+    assert sent_events(ws, "subscribe_listener") == [{"fields": ["a", "b", "c", "z"]}]
+
+
+def test_listen_calls_each_matched_listener_once_in_registration_order(obj, listened):
+    receive(obj, "receive_listen", {"fields": {"c": 3, "a": 1, "x": 0, "b": 2}})
+
+    assert listened == [("first", {"a": 1, "b": 2}), ("second", {"c": 3, "a": 1})]
+    # the fields keep the order in which they were received
+    assert list(listened[0][1]) == ["a", "b"]
+    assert list(listened[1][1]) == ["c", "a"]
+
+
+def test_listen_ignores_unlistened_fields(obj, listened):
+    receive(obj, "receive_listen", {"fields": {"x": 0}})
+
+    assert listened == []
+
+
+@pytest.fixture
+def actions(obj):
+    values = []
+    obj.on_action_recv("act", lambda value: values.append(value), log_reception=False)
+    return values
+
+
+def test_action_is_executed(obj, actions):
+    receive(obj, "receive_action", {"id": "act", "value": 1})
+
+    assert actions == [1]
+
+
+def test_action_batch_skips_invalid_elements(obj, actions, capsys):
+    receive(
+        obj,
+        "receive_action",
+        [
+            {"id": "act", "value": 1},
+            {"id": "act"},
+            "act",
+            {"id": "unknown", "value": 3},
+            {"id": "act", "value": None},
+        ],
+    )
+    out = capsys.readouterr().out
+
+    assert actions == [1, None]
+    assert out.count("does not have a valid structure") == 2
+    assert "The protocol with the id 'unknown' is not implemented" in out
+
+
+def test_stop_returns_when_the_sender_is_blocked(obj, ws, monkeypatch):
+    monkeypatch.setattr("aliot.aliot_obj._STOP_FLUSH_TIMEOUT", 0.1)
+    unblock = threading.Event()
+    ws.sock.send = lambda payload, opcode=None: unblock.wait()
+    connect(obj, ws)
+
+    obj.stop()
+    unblock.set()
+
+    assert ws.closed
+
+
+def test_nested_action_batches_are_executed_in_order(obj, actions):
+    receive(
+        obj,
+        "receive_action",
+        [
+            {"id": "act", "value": 1},
+            [{"id": "act", "value": 2}, [{"id": "act", "value": 3}]],
+            {"id": "act", "value": 4},
+        ],
+    )
+
+    assert actions == [1, 2, 3, 4]
@@ -0,0 +1,15 @@
+from aliot.decoder import DefaultDecoder
+
+
+def test_decode_bytes_and_str():
+    assert DefaultDecoder().decode(b'{"a": [1, null]}') == {"a": [1, None]}
+    assert DefaultDecoder().decode('{"a": [1, null]}') == {"a": [1, None]}
+
+
+def test_decode_without_orjson(monkeypatch):
+    monkeypatch.setattr("aliot.decoder.orjson", None)
+    assert DefaultDecoder().decode(b'{"a": "\\u00e9"}') == {"a": "é"}
+
+
+def test_decode_lone_surrogate():
+    assert DefaultDecoder().decode(b'{"a": "\\ud800"}') == {"a": "\ud800"}
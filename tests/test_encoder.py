@@ -0,0 +1,19 @@
+import json
+
+from aliot.encoder import DefaultEncoder
+
+
+def test_encode_big_int():
+    value = {"big": 2 ** 70}
+    assert json.loads(DefaultEncoder().encode(value)) == value
+
+
+def test_encode_non_str_keys_and_unknown_objects():
+    value = {1: object}
+    assert json.loads(DefaultEncoder().encode(value)) == {"1": str(object)}
+
+
+def test_encode_without_orjson(monkeypatch):
+    monkeypatch.setattr("aliot.encoder.orjson", None)
+    value = {"a": [1, 2.5, None], "big": 2 ** 70}
+    assert json.loads(DefaultEncoder().encode(value)) == value